@@ -0,0 +1,33 @@
+# vim: ts=4 sw=4 expandtab
+# cython: language_level=2
+""" Compiled version of lint._walk_tree_py, which runs for every node in
+every script. Build it with "make speedups"; lint falls back to the
+pure-Python version if this module is missing. TestLint.testWalkTree checks
+that both visit nodes in the same order.
+"""
+
+cdef _walk(node, dict push_map, dict pop_map):
+    cdef object kind = node.kind
+    cdef tuple key = (kind, node.opcode)
+    cdef object visitor, kid
+
+    if kind in push_map:
+        for visitor in push_map[kind]:
+            visitor(node)
+    if key in push_map:
+        for visitor in push_map[key]:
+            visitor(node)
+
+    for kid in node.kids:
+        if kid:
+            _walk(kid, push_map, pop_map)
+
+    if kind in pop_map:
+        for visitor in pop_map[kind]:
+            visitor(node)
+    if key in pop_map:
+        for visitor in pop_map[key]:
+            visitor(node)
+
+def walk_tree(node, dict push_map, dict pop_map):
+    _walk(node, push_map, pop_map)
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # vim: ts=4 sw=4 expandtab
+import bisect
+import functools
 import os.path
 import re
+import sys
 
 import conf
 import fs
@@ -15,12 +18,31 @@ import util
 from jsengine.parser import kind as tok
 from jsengine.parser import op
 
+# The scope checks and reporting run once per node, so bind the node kinds
+# and opcodes they compare against here instead of looking them up each time.
+_TOK_CASE = tok.CASE
+_TOK_CATCH = tok.CATCH
+_TOK_COLON = tok.COLON
+_TOK_DEFAULT = tok.DEFAULT
+_TOK_LC = tok.LC
+_TOK_NAME = tok.NAME
+_TOK_RC = tok.RC
+_TOK_SEMI = tok.SEMI
+_TOK_VAR = tok.VAR
+_TOK_WITH = tok.WITH
+_OP_ARGNAME = op.ARGNAME
+_OP_NAMEDFUNOBJ = op.NAMEDFUNOBJ
+_ASSIGNMENT_KINDS = (tok.ASSIGN, tok.INC, tok.DEC)
+_DECLARED_FUNCTION_OPCODES = (None, op.CLOSURE)
+
 _newline_kinds = (
     'eof', 'comma', 'dot', 'semi', 'colon', 'lc', 'rc', 'lp', 'rb', 'assign',
     'relop', 'hook', 'plus', 'minus', 'star', 'divop', 'eqop', 'shop', 'or',
     'and', 'bitor', 'bitxor', 'bitand', 'else', 'try'
 )
 
+_html_extensions = frozenset(['.htm', '.html'])
+
 _globals = frozenset([
     'Array', 'Boolean', 'Math', 'Number', 'String', 'RegExp', 'Script', 'Date',
     'isNaN', 'isFinite', 'parseFloat', 'parseInt',
@@ -33,6 +55,15 @@ _globals = frozenset([
     'arguments', 'undefined'
 ])
 
+# The keyword must either match or be separated by a space.
+_control_comment_re = re.compile(r"""
+    ^(ignoreall|ignore|end|option\ explicit|import|fallthru|pass|declare|
+      unused|content-type)
+    (?:\s(.*))?\Z
+""", re.IGNORECASE | re.UNICODE | re.DOTALL | re.VERBOSE)
+
+_content_type_re = re.compile(r'content-type', re.IGNORECASE)
+
 def _find_function(node):
     while node and node.kind != tok.FUNCTION:
         node = node.parent
@@ -57,37 +88,28 @@ def _parse_control_comment(comment):
     else:
         return None
 
-    keywords = (
-        'ignoreall',
-        'ignore',
-        'end',
-        'option explicit',
-        'import',
-        'fallthru',
-        'pass',
-        'declare',
-        'unused',
-        'content-type',
-    )
-    for keyword in keywords:
-        # The keyword must either match or be separated by a space.
-        if control_comment.lower() == keyword or \
-            (control_comment.lower().startswith(keyword) and \
-             control_comment[len(keyword)].isspace()):
-            parms = control_comment[len(keyword):].strip()
-            return (comment, keyword, parms.strip())
-
-class Scope:
+    match = _control_comment_re.match(control_comment)
+    if match:
+        keyword, parms = match.groups()
+        return (comment, keyword.lower(), (parms or '').strip())
+
+class Scope(object):
     """ Outer-level scopes will never be associated with a node.
         Inner-level scopes will always be associated with a node.
     """
+    __slots__ = ('_parent', '_kids', '_identifier_nodes', '_identifier_types',
+                 '_references', '_unused', '_node', '_resolve_cache')
     def __init__(self):
         self._parent = None
         self._kids = []
-        self._identifiers = {}
+        # Identifier nodes and types are kept in parallel, keyed by name.
+        self._identifier_nodes = {}
+        self._identifier_types = {}
         self._references = []
         self._unused = []
         self._node = None
+        # Populated once the scope is complete; see _find_warnings.
+        self._resolve_cache = None
     def add_scope(self, node):
         assert not node is None
         self._kids.append(Scope())
@@ -98,33 +120,37 @@ class Scope:
         assert type_ in ('arg', 'function', 'var'), \
             'Unrecognized identifier type: %s' % type_
         assert isinstance(name, basestring)
-        self._identifiers[name] = {
-            'node': node,
-            'type': type_
-        }
+        assert self._resolve_cache is None, 'Scope has already been resolved'
+        self._identifier_nodes[name] = node
+        self._identifier_types[name] = type_
     def add_reference(self, name, node):
         self._references.append((name, node))
     def set_unused(self, name, node):
         self._unused.append((name, node))
     def get_identifier(self, name):
-        if name in self._identifiers:
-            return self._identifiers[name]['node']
-        else:
-            return None
+        return self._identifier_nodes.get(name)
     def get_identifier_type(self, name):
-        if name in self._identifiers:
-            return self._identifiers[name]['type']
-        else:
-            return None
+        return self._identifier_types.get(name)
     def get_identifiers(self):
         "returns a list of names"
-        return self._identifiers.keys()
+        return self._identifier_nodes.keys()
     def resolve_identifier(self, name):
-        if name in self._identifiers:
-            return self, self._identifiers[name]['node']
-        if self._parent:
-            return self._parent.resolve_identifier(name)
-        return None
+        cache = self._resolve_cache
+        if cache is not None and name in cache:
+            return cache[name]
+
+        resolved = None
+        scope = self
+        while scope is not None:
+            nodes = scope._identifier_nodes
+            if name in nodes:
+                resolved = scope, nodes[name]
+                break
+            scope = scope._parent
+
+        if cache is not None:
+            cache[name] = resolved
+        return resolved
     def get_identifier_warnings(self):
         """ Returns a tuple of unreferenced and undeclared, where each is a list
             of (scope, name, node) tuples.
@@ -139,9 +165,12 @@ class Scope:
         # to a list of:
         #   [ (scope, name, node) ]
         # sorted by node position.
-        unreferenced = [(key[0], key[1], node) for key, node
-                        in unreferenced.items()]
-        unreferenced.sort(key=lambda x: x[2].start_offset)
+        # The index breaks ties so that scopes and nodes are never compared.
+        unreferenced = [(node.start_offset, i, key[0], key[1], node)
+                        for i, (key, node) in enumerate(unreferenced.items())]
+        unreferenced.sort()
+        unreferenced = [(scope, name, node) for offset, i, scope, name, node
+                        in unreferenced]
 
         return {
             'unreferenced': unreferenced,
@@ -160,75 +189,107 @@ class Scope:
                 (scope, name, node)
             ]
         """
-        if self._node and self._node.kind == tok.WITH:
-            is_in_with_scope = True
-
-        # Add all identifiers as unreferenced. Children scopes will remove
-        # them if they are referenced.  Variables need to be keyed by name
-        # instead of node, because function parameters share the same node.
-        for name, info in self._identifiers.items():
-            unreferenced[(self, name)] = info['node']
-
-        # Check for variables that hide an identifier in a parent scope.
-        if self._parent:
-            for name, info in self._identifiers.items():
-                if self._parent.resolve_identifier(name):
-                    obstructive.append((self, name, info['node']))
-
-        # Remove all declared variables from the "unreferenced" set; add all
-        # undeclared variables to the "undeclared" list.
-        for name, node in self._references:
-            resolved = self.resolve_identifier(name)
-            if resolved:
-                # Make sure this isn't an assignment.
-                if node.parent.kind in (tok.ASSIGN, tok.INC, tok.DEC) and \
-                   node.node_index == 0 and \
-                   node.parent.parent.kind == tok.SEMI:
-                    continue
-                unreferenced.pop((resolved[0], name), None)
-            else:
-                # with statements cannot have undeclared identifiers.
-                if not is_in_with_scope:
-                    undeclared.append((self, name, node))
-
-        # Remove all variables that have been set as "unused".
-        for name, node in self._unused:
-            resolved = self.resolve_identifier(name)
-            if resolved:
-                unreferenced.pop((resolved[0], name), None)
-            else:
-                undeclared.append((self, name, node))
-
-        for child in self._kids:
-            child._find_warnings(unreferenced, undeclared, obstructive,
+        # Walk the scopes in order with an explicit stack. Each entry is
+        # (scope, is_in_with_scope).
+        stack = [(self, is_in_with_scope)]
+        while stack:
+            scope, is_in_with_scope = stack.pop()
+            if scope._node and scope._node.kind == _TOK_WITH:
+                is_in_with_scope = True
+            _find_scope_warnings(scope, unreferenced, undeclared, obstructive,
                                  is_in_with_scope)
+            stack.extend((kid, is_in_with_scope)
+                         for kid in reversed(scope._kids))
     def find_scope(self, node):
-        for kid in self._kids:
-            scope = kid.find_scope(node)
-            if scope:
+        # Check the children of each scope before the scope itself. Each
+        # entry is (scope, popping); a scope is pushed a second time so that
+        # it is checked after all of its children.
+        stack = [(self, False)]
+        while stack:
+            scope, popping = stack.pop()
+            if not popping:
+                stack.append((scope, True))
+                stack.extend((kid, False) for kid in reversed(scope._kids))
+                continue
+
+            # Always add it to the outer scope.
+            if not scope._parent:
+                assert not scope._node
                 return scope
 
-        # Always add it to the outer scope.
-        if not self._parent:
-            assert not self._node
-            return self
+            # Conditionally add it to an inner scope.
+            assert scope._node
+            if (node.start_offset >= scope._node.start_offset and \
+                node.end_offset <= scope._node.end_offset):
+                return scope
 
-        # Conditionally add it to an inner scope.
-        assert self._node
-        if (node.start_offset >= self._node.start_offset and \
-            node.end_offset <= self._node.end_offset):
-            return self
+def _find_scope_warnings(scope, unreferenced, undeclared, obstructive,
+                         is_in_with_scope):
+    """ Finds the identifier warnings for a single scope. See
+        Scope._find_warnings for the arguments.
+    """
+    # All declarations have been made by now, and parents are visited
+    # before their children, so lookups from here on can be cached.
+    scope._resolve_cache = {}
+
+    # Add all identifiers as unreferenced. Children scopes will remove
+    # them if they are referenced.  Variables need to be keyed by name
+    # instead of node, because function parameters share the same node.
+    for name, node in scope._identifier_nodes.items():
+        unreferenced[(scope, name)] = node
+
+    # Check for variables that hide an identifier in a parent scope.
+    if scope._parent:
+        for name, node in scope._identifier_nodes.items():
+            if scope._parent.resolve_identifier(name):
+                obstructive.append((scope, name, node))
+
+    # Remove all declared variables from the "unreferenced" set; add all
+    # undeclared variables to the "undeclared" list.
+    for name, node in scope._references:
+        resolved = scope.resolve_identifier(name)
+        if resolved:
+            # Make sure this isn't an assignment.
+            if node.parent.kind in _ASSIGNMENT_KINDS and \
+               node.node_index == 0 and \
+               node.parent.parent.kind == _TOK_SEMI:
+                continue
+            unreferenced.pop((resolved[0], name), None)
+        else:
+            # with statements cannot have undeclared identifiers.
+            if not is_in_with_scope:
+                undeclared.append((scope, name, node))
+
+    # Remove all variables that have been set as "unused".
+    for name, node in scope._unused:
+        resolved = scope.resolve_identifier(name)
+        if resolved:
+            unreferenced.pop((resolved[0], name), None)
+        else:
+            undeclared.append((scope, name, node))
 
-class _Script:
+class _Script(object):
+    __slots__ = ('_imports', 'scope', '_global_cache')
     def __init__(self):
         self._imports = set()
         self.scope = Scope()
+        self._global_cache = {}
     def importscript(self, script):
+        assert not self._global_cache, \
+            'Scripts must be imported before looking up globals'
         self._imports.add(script)
     def hasglobal(self, name):
-        return not self._findglobal(name, set()) is None
+        # The same undeclared name is usually referenced many times.
+        try:
+            return self._global_cache[name]
+        except KeyError:
+            found = not self._findglobal(name, set()) is None
+            self._global_cache[name] = found
+            return found
     def _findglobal(self, name, searched):
-        """ searched is a set of all searched scripts """
+        """ searched is a set of all searched scripts. Returns a script that
+            declares the name or imports a script that does.
+        """
         # Avoid recursion.
         if self in searched:
             return
@@ -236,6 +297,12 @@ class _Script:
         # Check this scope.
         if self.scope.get_identifier(name):
             return self
+
+        # Reuse an earlier lookup from this script. Only hits can be trusted;
+        # with circular imports, a miss may predate declarations that the
+        # importing script made afterwards.
+        if self._global_cache.get(name):
+            return self
         searched.add(self)
 
         # Search imported scopes.
@@ -245,42 +312,52 @@ class _Script:
                 return global_
 
 def _findhtmlscripts(contents, default_version):
-    starttag = None
+    fromattr = util.JSVersion.fromattr
+    isvalidversion = jsparse.isvalidversion
+    is_compilable_unit = jsparse.is_compilable_unit
+
+    in_script = False
     for tag in htmlparse.findscripttags(contents):
-        if tag['type'] == 'start':
+        type_ = tag['type']
+        if type_ == 'start':
             # Ignore nested start tags.
-            if not starttag:
-                jsversion =  util.JSVersion.fromattr(tag['attr'], default_version)
-                starttag = dict(tag, jsversion=jsversion)
-                src = tag['attr'].get('src')
+            if not in_script:
+                in_script = True
+                attr = tag['attr']
+                jsversion = fromattr(attr, default_version)
+                # htmlparse returns 1-based line numbers. Calculate the
+                # position of the script's contents.
+                start_offset = tag['offset'] + tag['len']
+                src = attr.get('src')
                 if src:
                     yield {
                         'type': 'external',
                         'jsversion': jsversion,
                         'src': src,
                     }
-        elif tag['type'] == 'end':
-            if not starttag:
+        elif type_ == 'end':
+            if not in_script:
                 continue
 
-            # htmlparse returns 1-based line numbers. Calculate the
-            # position of the script's contents.
-            start_offset = starttag['offset'] + starttag['len']
             end_offset = tag['offset']
             script = contents[start_offset:end_offset]
 
-            if not jsparse.isvalidversion(starttag['jsversion']) or \
-               jsparse.is_compilable_unit(script, starttag['jsversion']):
+            if not isvalidversion(jsversion) or \
+               is_compilable_unit(script, jsversion):
                 if script.strip():
                     yield {
                         'type': 'inline',
-                        'jsversion': starttag['jsversion'],
+                        'jsversion': jsversion,
                         'offset': start_offset,
                         'contents': script,
                     }
-                starttag = None
+                in_script = False
         else:
-            assert False, 'Invalid internal tag type %s' % tag['type']
+            assert False, 'Invalid internal tag type %s' % type_
+
+def _announce(path):
+    # Prints the name of each file as lint_file starts on it.
+    print path
 
 def lint_files(paths, lint_error, encoding, conf=conf.Conf(), printpaths=True):
     def lint_file(path, kind, jsversion, encoding):
@@ -294,13 +371,18 @@ def lint_files(paths, lint_error, encoding, conf=conf.Conf(), printpaths=True):
             pos = node_positions.from_offset(offset)
             return lint_error(normpath, pos.line, pos.col, errname, errdesc)
 
+        # Imported scripts are usually requested with the same path
+        # string, so check it before normalizing it.
+        if path in raw_lint_cache:
+            return raw_lint_cache[path]
         normpath = fs.normpath(path)
         if normpath in lint_cache:
+            raw_lint_cache[path] = lint_cache[normpath]
             return lint_cache[normpath]
         if printpaths:
-            print normpath
+            _announce(normpath)
 
-        lint_cache[normpath] = _Script()
+        lint_cache[normpath] = raw_lint_cache[path] = _Script()
         try:
             contents = fs.readfile(path, encoding)
         except IOError, error:
@@ -334,9 +416,10 @@ def lint_files(paths, lint_error, encoding, conf=conf.Conf(), printpaths=True):
         return lint_cache[normpath]
 
     lint_cache = {}
+    raw_lint_cache = {}
     for path in paths:
         ext = os.path.splitext(path)[1]
-        if ext.lower() in ['.htm', '.html']:
+        if ext.lower() in _html_extensions:
             lint_file(path, 'html', None, encoding)
         else:
             lint_file(path, 'js', None, encoding)
@@ -348,36 +431,46 @@ def _lint_script_part(script_offset, jsversion, script, script_cache, conf,
                        'redeclared_var', 'var_hides_arg'):
             parse_errors.append((offset, msg, msg_args))
 
+    def consume_comment(comments, comment_offsets, start, end):
+        """ Looks for a comment between start and end, exclusive. If found,
+            it is replaced with None so that it is only used once.
+        """
+        # Control comments are added in order and never overlap, so the
+        # first comment after start is the only candidate.
+        i = bisect.bisect_right(comment_offsets, start)
+        while i < len(comments) and comments[i] is None:
+            i += 1
+        if i < len(comments) and comments[i].end_offset < end:
+            comments[i] = None
+            return True
+        return False
+
     def report(node, errname, offset=0, **errargs):
-        if errname == 'empty_statement' and node.kind == tok.LC:
-            for pass_ in passes:
-                if pass_.start_offset > node.start_offset and \
-                   pass_.end_offset < node.end_offset:
-                    passes.remove(pass_)
-                    return
+        if errname == 'empty_statement' and node.kind == _TOK_LC:
+            if consume_comment(passes, pass_offsets, node.start_offset,
+                               node.end_offset):
+                return
 
         if errname == 'missing_break':
             # Find the end of the previous case/default and the beginning of
             # the next case/default.
-            assert node.kind in (tok.CASE, tok.DEFAULT)
+            assert node.kind in (_TOK_CASE, _TOK_DEFAULT)
             prevnode = node.parent.kids[node.node_index-1]
             expectedfallthru = prevnode.end_offset, node.start_offset
         elif errname == 'missing_break_for_last_case':
             # Find the end of the current case/default and the end of the
             # switch.
-            assert node.parent.kind == tok.LC
+            assert node.parent.kind == _TOK_LC
             expectedfallthru = node.end_offset, node.parent.end_offset
         else:
             expectedfallthru = None
 
         if expectedfallthru:
+            # Look for a fallthru between the end of the current case or
+            # default statement and the beginning of the next token.
             start, end = expectedfallthru
-            for fallthru in fallthrus:
-                # Look for a fallthru between the end of the current case or
-                # default statement and the beginning of the next token.
-                if fallthru.start_offset > start and fallthru.end_offset < end:
-                    fallthrus.remove(fallthru)
-                    return
+            if consume_comment(fallthrus, fallthru_offsets, start, end):
+                return
 
         report_lint(node, errname, offset, **errargs)
 
@@ -386,25 +479,30 @@ def _lint_script_part(script_offset, jsversion, script, script_cache, conf,
     unused_identifiers = []
     import_paths = []
     fallthrus = []
+    fallthru_offsets = []
     passes = []
+    pass_offsets = []
 
     possible_comments = jsparse.findpossiblecomments(script, script_offset)
 
     # Check control comments for the correct version. It may be this comment
     # isn't a valid comment (for example, it might be inside a string literal)
     # After parsing, validate that it's legitimate.
+    # Most scripts have no such comment, so check the text before looking
+    # at each comment.
     jsversionnode = None
-    for comment in possible_comments:
-        cc = _parse_control_comment(comment)
-        if cc:
-            node, keyword, parms = cc
-            if keyword == 'content-type':
-                ccversion = util.JSVersion.fromtype(parms)
-                if ccversion:
-                    jsversion = ccversion
-                    jsversionnode = node
-                else:
-                    report(node, 'unsupported_version', version=parms)
+    if _content_type_re.search(script):
+        for comment in possible_comments:
+            cc = _parse_control_comment(comment)
+            if cc:
+                node, keyword, parms = cc
+                if keyword == 'content-type':
+                    ccversion = util.JSVersion.fromtype(parms)
+                    if ccversion:
+                        jsversion = ccversion
+                        jsversionnode = node
+                    else:
+                        report(node, 'unsupported_version', version=parms)
 
     if not jsparse.isvalidversion(jsversion):
         report_lint(jsversionnode, 'unsupported_version', script_offset,
@@ -457,8 +555,10 @@ def _lint_script_part(script_offset, jsversion, script, script_cache, conf,
                     import_paths.append(parms)
             elif keyword == 'fallthru':
                 fallthrus.append(node)
+                fallthru_offsets.append(node.start_offset)
             elif keyword == 'pass':
                 passes.append(node)
+                pass_offsets.append(node.start_offset)
         else:
             if comment.opcode == op.C_COMMENT:
                 # Look for nested C-style comments.
@@ -496,9 +596,11 @@ def _lint_script_part(script_offset, jsversion, script, script_cache, conf,
     _lint_node(root, visitors)
 
     for fallthru in fallthrus:
-        report(fallthru, 'invalid_fallthru')
+        if fallthru:
+            report(fallthru, 'invalid_fallthru')
     for fallthru in passes:
-        report(fallthru, 'invalid_pass')
+        if fallthru:
+            report(fallthru, 'invalid_pass')
 
     # Process imports by copying global declarations into the universal scope.
     for path in import_paths:
@@ -517,27 +619,30 @@ def _lint_script_part(script_offset, jsversion, script, script_cache, conf,
 
 def _lint_script_parts(script_parts, script_cache, lint_error, conf, import_callback):
     def report_lint(node, errname, offset=0, **errargs):
+        if errname in disabled_warnings:
+            return
         errdesc = warnings.format_error(errname, **errargs)
-        _report(offset or node.start_offset, errname, errdesc, True)
+        _report(offset or node.start_offset, errname, errdesc)
 
     def report_native(offset, errname, errargs):
+        if errname in disabled_warnings:
+            return
         errdesc = warnings.format_error(errname, **errargs)
-        _report(offset, errname, errdesc, False)
-
-    def _report(offset, errname, errdesc, require_key):
-        try:
-            if not conf[errname]:
-                return
-        except KeyError, err:
-            if require_key:
-                raise
+        _report(offset, errname, errdesc)
 
-        for start, end in ignores:
-            if offset >= start and offset <= end:
-                return
+    def _report(offset, errname, errdesc):
+        # Ignored ranges are added in order and never overlap, so only the
+        # last range starting at or before the offset can contain it.
+        i = bisect.bisect_right(ignores, (offset, sys.maxint))
+        if i and offset <= ignores[i-1][1]:
+            return
 
         return lint_error(offset, errname, errdesc)
 
+    # Look up the settings once instead of for every reported warning.
+    disabled_warnings = frozenset(name for name in warnings.warnings
+                                  if not conf[name])
+
     for script_offset, jsversion, script in script_parts:
         ignores = []
         _lint_script_part(script_offset, jsversion, script, script_cache, conf, ignores,
@@ -545,10 +650,9 @@ def _lint_script_parts(script_parts, script_cache, lint_error, conf, import_call
 
     scope = script_cache.scope
     identifier_warnings = scope.get_identifier_warnings()
+    declared = _globals.union(conf['declarations'])
     for decl_scope, name, node in identifier_warnings['undeclared']:
-        if name in conf['declarations']:
-            continue
-        if name in _globals:
+        if name in declared:
             continue
         if not script_cache.hasglobal(name):
             report_lint(node, 'undeclared_identifier', name=name)
@@ -587,7 +691,7 @@ def _warn_or_declare(scope, name, type_, node, report):
     if other and parent_scope == scope:
         # Only warn about duplications in this scope.
         # Other scopes will be checked later.
-        if other.kind == tok.NAME and other.opcode == op.ARGNAME:
+        if other.kind == _TOK_NAME and other.opcode == _OP_ARGNAME:
             report(node, 'var_hides_arg', name=name)
         else:
             report(node, 'redeclared_var', name=name)
@@ -603,21 +707,21 @@ def _get_scope_checks(scope, report):
         """
         @visitation.visit('push', tok.NAME)
         def _name(self, node):
-            if node.node_index == 0 and node.parent.kind == tok.COLON and node.parent.parent.kind == tok.RC:
+            if node.node_index == 0 and node.parent.kind == _TOK_COLON and node.parent.parent.kind == _TOK_RC:
                 return # left side of object literal
-            if node.parent.kind == tok.VAR:
+            if node.parent.kind == _TOK_VAR:
                 _warn_or_declare(scopes[-1], node.atom, 'var', node, report)
                 return
-            if node.parent.kind == tok.CATCH:
+            if node.parent.kind == _TOK_CATCH:
                 scopes[-1].add_declaration(node.atom, node, 'var')
             scopes[-1].add_reference(node.atom, node)
 
         @visitation.visit('push', tok.FUNCTION)
         def _push_func(self, node):
-            if node.opcode in (None, op.CLOSURE) and node.fn_name:
+            if node.opcode in _DECLARED_FUNCTION_OPCODES and node.fn_name:
                 _warn_or_declare(scopes[-1], node.fn_name, 'function', node, report)
             self._push_scope(node)
-            if node.opcode == op.NAMEDFUNOBJ and node.fn_name:
+            if node.opcode == _OP_NAMEDFUNOBJ and node.fn_name:
                 scopes[-1].add_declaration(node.fn_name, node, 'function')
             for var_name in node.fn_args:
                 if scopes[-1].get_identifier(var_name.atom):
@@ -635,21 +739,40 @@ def _get_scope_checks(scope, report):
     return scope_checks
 
 
-def _lint_node(node, visitors):
+def _lint_node(root, visitors):
+    _walk_tree(root, visitors.get('push', {}), visitors.get('pop', {}))
 
-    for kind in (node.kind, (node.kind, node.opcode)):
-        if kind in visitors['push']:
-            for visitor in visitors['push'][kind]:
-                visitor(node)
-
-    for child in node.kids:
-        if child:
-            _lint_node(child, visitors)
-
-    for kind in (node.kind, (node.kind, node.opcode)):
-        if kind in visitors['pop']:
-            for visitor in visitors['pop'][kind]:
-                visitor(node)
+def _walk_tree_py(node, push_map, pop_map):
+    """ Calls the "push" visitors for the node, walks its children, and then
+        calls the "pop" visitors.
+    """
+    # Note that (kind, None) is a valid key, so it is always checked.
+    kind = node.kind
+    key = (kind, node.opcode)
+
+    if kind in push_map:
+        for visitor in push_map[kind]:
+            visitor(node)
+    if key in push_map:
+        for visitor in push_map[key]:
+            visitor(node)
+
+    for kid in node.kids:
+        if kid:
+            _walk_tree_py(kid, push_map, pop_map)
+
+    if kind in pop_map:
+        for visitor in pop_map[kind]:
+            visitor(node)
+    if key in pop_map:
+        for visitor in pop_map[key]:
+            visitor(node)
+
+# Use the compiled traversal if it has been built (see "make speedups").
+try:
+    from _lint_node import walk_tree as _walk_tree
+except ImportError:
+    _walk_tree = _walk_tree_py
 
 
 class TestLint(unittest.TestCase):
@@ -673,6 +796,26 @@ ok&amp;
             ('test.js', None),
             (None, "<!--\nvar s = '<script></script>';\n-->")
         ])
+    def testWalkTree(self):
+        # The compiled walk, if built, must visit nodes in the same order.
+        root = jsparse.parse('a = b; function f(c) { with (c) { x++; } }',
+                             None, None)
+        def make_maps(events):
+            def visit(event, node):
+                events.append((event, node.kind, node.opcode))
+            maps = {}
+            for event in ('push', 'pop'):
+                maps[event] = {}
+                for key in (tok.NAME, tok.FUNCTION, tok.WITH, tok.SEMI,
+                            (tok.ASSIGN, None), (tok.INC, op.NAMEINC)):
+                    maps[event][key] = [functools.partial(visit, event)]
+            return maps['push'], maps['pop']
+        expected = []
+        _walk_tree_py(root, *make_maps(expected))
+        events = []
+        _walk_tree(root, *make_maps(events))
+        self.assertEquals(events, expected)
+        self.assertEquals(len(expected), 20)
     def testJSVersion(self):
         def parsetag(starttag, default_version=None):
             script, = _findhtmlscripts(starttag + '/**/</script>', \